@@ -0,0 +1,546 @@
+"""
+LOAD SIMULATOR
+
+Drives the real Music cog with many simulated guilds, without a Discord connection.
+Every guild joins a voice channel and keeps issuing play, skip, queue and lyrics commands.
+
+What is faked:
+  - Discord: the commands.Context, guilds, channels and members. Messages sent by the bot only cost
+    --send-latency seconds.
+  - Voice: a fake voice client consumes the audio frames in real time, in a thread per guild like
+    discord.py does. A frame sent more than --jitter seconds after its deadline counts as dropped.
+  - youtube_dl: YoutubeDL.extract_info sleeps --extract-latency seconds and returns synthetic info.
+  - ffmpeg: the audio source returns silence frames for --track-seconds seconds.
+  - Genius: a local HTTP server answers the search and lyrics requests after --genius-latency seconds.
+
+Run it from the root of the repository:
+  python -m benchmarks.loadsim --guilds 50,100,200 --duration 30
+
+For every guild count it reports the command latency percentiles, the event loop lag,
+the frames dropped per guild and the process RSS.
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import discord
+import requests
+from discord.ext import commands
+from discord.ext.commands.view import StringView
+
+import misc.genius
+import modules.voice
+from misc.genius import GeniusSong
+from misc.track_index import TrackIndex
+from modules.voice import Music, YTDLSource
+
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+FRAME_DELAY = discord.opus.Encoder.FRAME_LENGTH / 1000.0
+SILENCE_FRAME = b"\0" * FRAME_SIZE
+
+DEFAULT_COMMANDS = {"play": 0.25, "queue": 0.35, "skip": 0.2, "lyrics": 0.2}
+
+LYRICS = "\n\n".join("\n".join(f"line {line} of verse {verse}" for line in range(8)) for verse in range(6))
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def rss_megabytes() -> float:
+    """Resident set size of the process"""
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    import resource
+    # Peak RSS, in KB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+
+# Extractor and ffmpeg stand-ins
+
+class FakeYoutubeDL:
+    """Stands in for youtube_dl.YoutubeDL, every call blocks its executor thread for the latency"""
+
+    def __init__(self, latency: float, track_seconds: int):
+        self.latency = latency
+        self.track_seconds = track_seconds
+
+    def extract_info(self, url: str, download: bool = True, process: bool = True) -> dict:
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        video_id = re.sub(r"\W", "", url)[-11:]
+        webpage_url = f"https://www.youtube.com/watch?v={video_id}"
+        if not process:
+            return {"entries": [{"webpage_url": webpage_url}]}
+
+        return {
+            "webpage_url": webpage_url,
+            "url": f"https://stream.invalid/{video_id}",
+            "title": f"Simulated track {video_id}",
+            "track": f"Track {video_id}",
+            "artist": "Simulated Artist",
+            "uploader": "SimulatedArtistVEVO",
+            "thumbnail": None,
+            "duration": self.track_seconds,
+        }
+
+
+class FakeFFmpegAudio(discord.AudioSource):
+    """Stands in for discord.FFmpegPCMAudio, it returns silence for the duration of the track"""
+    track_seconds = 20
+
+    def __init__(self, source: str, **kwargs):
+        self.frames = int(self.track_seconds / FRAME_DELAY)
+
+    def read(self) -> bytes:
+        if self.frames <= 0:
+            return b""
+        self.frames -= 1
+        return SILENCE_FRAME
+
+    def is_opus(self) -> bool:
+        return False
+
+
+# Genius stand-in
+
+class GeniusHandler(BaseHTTPRequestHandler):
+    latency = 0.2
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == "/search":
+            body = {"response": {"hits": [
+                {"result": {"title": query.get("q", [""])[0], "primary_artist": {"name": name}}}
+                for name in ("Genius Romanizations", "Simulated Artist", "Simulated Artists Band")
+            ]}}
+        elif url.path == "/lyrics":
+            body = {"lyrics": LYRICS}
+        else:
+            self.send_error(404)
+            return
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGenius:
+    """Stands in for lyricsgenius.Genius, it asks the local Genius server (blocking, like the real one)"""
+    base_url = ""
+    miss_ratio = 0.3
+
+    def __init__(self, token: str):
+        self.token = token
+
+    def search_song(self, song: str, artist: str = None):
+        lyrics = requests.get(f"{self.base_url}/lyrics", params={"q": song, "artist": artist}).json()["lyrics"]
+        # Some misses, so the slower search and artist matching path is used too
+        return SimpleNamespace(lyrics="" if random.random() < self.miss_ratio else lyrics)
+
+
+def start_genius_server(latency: float) -> ThreadingHTTPServer:
+    GeniusHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GeniusHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Discord stand-ins
+
+class FakeVoiceClient:
+    """Consumes the audio frames in real time in its own thread, like discord.player.AudioPlayer"""
+
+    def __init__(self, channel, jitter: float):
+        self.channel = channel
+        self.guild = channel.guild
+        self.jitter = jitter
+        self.encoder = None
+        self._thread = None
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+
+    def play(self, source: discord.AudioSource, *, after=None):
+        if self.is_playing():
+            raise discord.ClientException("Already playing audio.")
+
+        self._end = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(source, after), daemon=True)
+        self._thread.start()
+
+    def _run(self, source: discord.AudioSource, after):
+        loops = 0
+        start = time.perf_counter()
+        error = None
+        try:
+            while not self._end.is_set():
+                if not self._resumed.is_set():
+                    self._resumed.wait()
+                    loops = 0
+                    start = time.perf_counter()
+                    continue
+
+                loops += 1
+                data = source.read()
+                if not data:
+                    break
+
+                deadline = start + FRAME_DELAY * loops
+                if time.perf_counter() - deadline > self.jitter:
+                    self.guild.frames_dropped += 1
+                else:
+                    self.guild.frames_played += 1
+
+                time.sleep(max(0.0, deadline - time.perf_counter()))
+        except Exception as exc:
+            error = exc
+        finally:
+            source.cleanup()
+
+        if after is not None:
+            after(error)
+
+    def is_playing(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and self._resumed.is_set()
+
+    def is_paused(self) -> bool:
+        return not self._resumed.is_set()
+
+    def is_connected(self) -> bool:
+        return self.guild.voice_client is self
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        self.channel.guild.voice_client = None
+
+
+class FakeMessageable:
+    send_latency = 0.05
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.id = guild.id
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.sent += 1
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild, jitter: float):
+        self.guild = guild
+        self.id = guild.id
+        self.jitter = jitter
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self, self.jitter)
+        return self.guild.voice_client
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, jitter: float, shard_count: int):
+        self.id = guild_id
+        self.shard_id = guild_id % shard_count
+        self.voice_client = None
+        self.frames_played = 0
+        self.frames_dropped = 0
+        self.text_channel = FakeMessageable(self)
+        self.voice_channel = FakeVoiceChannel(self, jitter)
+        self.member = SimpleNamespace(id=guild_id, mention=f"<@{guild_id}>", bot=False,
+                                      voice=SimpleNamespace(channel=self.voice_channel))
+
+
+class FakeMessage:
+    def __init__(self, guild: FakeGuild, content: str):
+        self.guild = guild
+        self.author = guild.member
+        self.channel = guild.text_channel
+        self.content = content
+        self._state = None
+
+    async def add_reaction(self, emoji):
+        await asyncio.sleep(FakeMessageable.send_latency)
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeContext(commands.Context):
+    """A real commands.Context whose message, typing and send don't need a connection"""
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    def typing(self):
+        return FakeTyping()
+
+
+# Simulation
+
+class Simulation:
+    def __init__(self, args: argparse.Namespace, guild_count: int):
+        self.args = args
+        self.guild_count = guild_count
+        self.latencies: Dict[str, List[float]] = {name: [] for name in args.commands}
+        self.loop_lag: List[float] = []
+        self.rss: List[float] = []
+        self.errors = 0
+
+        self.bot = commands.Bot(command_prefix="!", loop=asyncio.get_event_loop())
+        self.cog = Music(self.bot)
+        self.bot.add_cog(self.cog)
+        self.guilds = [FakeGuild(i + 1, args.jitter, args.shards) for i in range(guild_count)]
+
+    async def invoke(self, guild: FakeGuild, name: str, argument: str = "", record: bool = True):
+        message = FakeMessage(guild, f"!{name} {argument}".strip())
+        ctx = FakeContext(message=message, bot=self.bot, prefix="!", view=StringView(argument),
+                          command=self.bot.get_command(name), invoked_with=name)
+
+        start = time.perf_counter()
+        try:
+            await self.bot.invoke(ctx)
+        except Exception:
+            self.errors += 1
+        else:
+            # The command errors are handled by the cog (and sent to the channel), not raised
+            if ctx.command_failed:
+                self.errors += 1
+        if record:
+            self.latencies[name].append(time.perf_counter() - start)
+
+    async def warm_up(self, guild: FakeGuild):
+        """Start with some songs in the queue. Not measured."""
+        for i in range(3):
+            await self.invoke(guild, "play", f"guild {guild.id} song {i}", record=False)
+
+    async def guild_task(self, guild: FakeGuild, end: float):
+        rng = random.Random(guild.id)
+        names, weights = zip(*self.args.commands.items())
+
+        while time.perf_counter() < end:
+            await asyncio.sleep(rng.expovariate(1 / self.args.think))
+            name = rng.choices(names, weights)[0]
+            await self.invoke(guild, name, f"guild {guild.id} song {rng.randrange(1000)}" if name == "play" else "")
+
+    async def monitor(self, end: float, interval: float = 0.05):
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(time.perf_counter() - start - interval)
+            if len(self.loop_lag) % 20 == 0:
+                self.rss.append(rss_megabytes())
+
+    async def run(self) -> dict:
+        await asyncio.gather(*(self.warm_up(guild) for guild in self.guilds))
+        for guild in self.guilds:
+            guild.frames_played = guild.frames_dropped = 0
+
+        # The measured window starts once every guild is playing
+        end = time.perf_counter() + self.args.duration
+        monitor = asyncio.ensure_future(self.monitor(end))
+        await asyncio.gather(*(self.guild_task(guild, end) for guild in self.guilds))
+        await monitor
+
+        self.cog.cog_unload()
+        for state in self.cog.voice_states.values():
+            state.audio_player.cancel()
+        await asyncio.sleep(0.1)
+
+        return self.report()
+
+    def report(self) -> dict:
+        dropped = {guild.id: guild.frames_dropped for guild in self.guilds}
+        played = {guild.id: guild.frames_played for guild in self.guilds}
+
+        total_frames = sum(dropped.values()) + sum(played.values())
+        return {
+            "guilds": self.guild_count,
+            "commands": {
+                name: {
+                    "count": len(values),
+                    "p50": percentile(values, 50),
+                    "p95": percentile(values, 95),
+                    "p99": percentile(values, 99),
+                    "max": max(values, default=0.0),
+                }
+                for name, values in self.latencies.items()
+            },
+            "loop_lag": {
+                "p50": percentile(self.loop_lag, 50),
+                "p99": percentile(self.loop_lag, 99),
+                "max": max(self.loop_lag, default=0.0),
+            },
+            "frames": {
+                "played": sum(played.values()),
+                "dropped": sum(dropped.values()),
+                "dropped_ratio": sum(dropped.values()) / total_frames if total_frames else 0.0,
+                "max_dropped_per_guild": max(dropped.values(), default=0),
+                "per_guild_dropped": dropped,
+            },
+            "rss_mb": {"peak": max(self.rss, default=rss_megabytes()), "end": rss_megabytes()},
+            "errors": self.errors,
+        }
+
+
+def missing_commands(report: dict, args: argparse.Namespace) -> List[str]:
+    """The simulated commands that didn't run in the measured window"""
+    return [name for name, weight in args.commands.items() if weight > 0 and not report["commands"][name]["count"]]
+
+
+def keeping_up(report: dict, args: argparse.Namespace) -> Optional[bool]:
+    """Whether the bot kept up, or None if some command wasn't measured (the window is too short)"""
+    if missing_commands(report, args):
+        return None
+    return report["frames"]["dropped_ratio"] <= args.max_drop_ratio and report["loop_lag"]["p99"] <= args.max_lag
+
+
+def print_report(report: dict, ok: Optional[bool]):
+    verdict = "NO VERDICT" if ok is None else "keeping up" if ok else "NOT KEEPING UP"
+    print(f"\n=== {report['guilds']} guilds: {verdict} ===")
+    print("{:<10}{:>8}{:>10}{:>10}{:>10}{:>10}".format("Command", "Count", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for name, stats in report["commands"].items():
+        print("{:<10}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            name, stats["count"], *(stats[key] * 1000 for key in ("p50", "p95", "p99", "max"))))
+
+    lag, frames = report["loop_lag"], report["frames"]
+    print(f"Loop lag:  p50 {lag['p50'] * 1000:.1f} ms, p99 {lag['p99'] * 1000:.1f} ms, max {lag['max'] * 1000:.1f} ms")
+    print(f"Frames:    {frames['played']} played, {frames['dropped']} dropped ({frames['dropped_ratio']:.2%}), "
+          f"worst guild {frames['max_dropped_per_guild']}")
+    print(f"RSS:       peak {report['rss_mb']['peak']:.1f} MB, end {report['rss_mb']['end']:.1f} MB")
+    print(f"Errors:    {report['errors']}")
+
+
+def install_fakes(args: argparse.Namespace) -> ThreadingHTTPServer:
+    """Replace the network facing parts of the bot with the local stand-ins"""
+    YTDLSource.ytdl = FakeYoutubeDL(args.extract_latency, args.track_seconds)
+    YTDLSource.track_index = TrackIndex()
+    FakeFFmpegAudio.track_seconds = args.track_seconds
+    modules.voice.discord.FFmpegPCMAudio = FakeFFmpegAudio
+
+    FakeMessageable.send_latency = args.send_latency
+    FakeGenius.miss_ratio = args.lyrics_miss
+    server = start_genius_server(args.genius_latency)
+    GeniusSong.BASE_URL = FakeGenius.base_url = f"http://127.0.0.1:{server.server_port}"
+    misc.genius.lyricsgenius = SimpleNamespace(Genius=FakeGenius)
+    return server
+
+
+def parse_commands(value: str) -> Dict[str, float]:
+    """play=0.25,queue=0.35,... -> {"play": 0.25, "queue": 0.35, ...}"""
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in DEFAULT_COMMANDS:
+            raise argparse.ArgumentTypeError(f"unknown command {name!r}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Simulate many guilds using the Music cog, offline.")
+    parser.add_argument("--guilds", default="10,50,100", help="comma separated guild counts to simulate")
+    parser.add_argument("--duration", type=float, default=30, help="seconds each guild count runs")
+    parser.add_argument("--think", type=float, default=3, help="mean seconds between the commands of a guild")
+    parser.add_argument("--commands", type=parse_commands, default=DEFAULT_COMMANDS,
+                        help="command weights, e.g. play=0.25,queue=0.35,skip=0.2,lyrics=0.2")
+    parser.add_argument("--track-seconds", type=int, default=20, help="duration of the simulated tracks")
+    parser.add_argument("--extract-latency", type=float, default=0.3, help="seconds per extract_info call")
+    parser.add_argument("--genius-latency", type=float, default=0.2, help="seconds per Genius request")
+    parser.add_argument("--lyrics-miss", type=float, default=0.3, help="ratio of fast lyrics lookups that miss")
+    parser.add_argument("--send-latency", type=float, default=0.05, help="seconds per message sent to Discord")
+    parser.add_argument("--jitter", type=float, default=0.06, help="lateness after which a frame is dropped")
+    parser.add_argument("--shards", type=int, default=1, help="number of simulated shards")
+    parser.add_argument("--max-drop-ratio", type=float, default=0.01, help="max dropped frames ratio to keep up")
+    parser.add_argument("--max-lag", type=float, default=0.1, help="max p99 loop lag in seconds to keep up")
+    parser.add_argument("--output", type=Path, help="write the reports to this JSON file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    server = install_fakes(args)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    reports = []
+    try:
+        for guild_count in (int(count) for count in args.guilds.split(",")):
+            simulation = Simulation(args, guild_count)
+            report = loop.run_until_complete(simulation.run())
+            ok = keeping_up(report, args)
+            report["keeping_up"] = ok
+            reports.append(report)
+            print_report(report, ok)
+            if ok is None:
+                print(f"No samples of: {', '.join(missing_commands(report, args))}. "
+                      f"Increase --duration or decrease --think.")
+    finally:
+        server.shutdown()
+        loop.close()
+
+    if args.output:
+        args.output.write_text(json.dumps(reports, indent=2))
+
+    limit = next((report["guilds"] for report in reports if report["keeping_up"] is False), None)
+    unmeasured = [str(report["guilds"]) for report in reports if report["keeping_up"] is None]
+    if limit is not None:
+        print(f"\nThe bot stops keeping up at {limit} guilds.")
+    elif unmeasured:
+        print(f"\nNo verdict: the commands weren't all measured with {', '.join(unmeasured)} guilds.")
+        return 1
+    else:
+        print(f"\nThe bot kept up with every guild count (up to {reports[-1]['guilds']}).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
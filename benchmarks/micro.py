@@ -0,0 +1,211 @@
+"""
+MICROBENCHMARKS
+
+Times the pure hot paths of the bot with fixed synthetic inputs.
+It runs offline, no Discord token or network connection is needed.
+
+Run it from the root of the repository:
+  python -m benchmarks.micro                   Run and compare with benchmarks/baseline.json
+  python -m benchmarks.micro --save-baseline   Run and store the results as the new baseline
+  python -m benchmarks.micro -k queue          Only run the benchmarks containing "queue"
+
+The results are written to benchmarks/results.json.
+The exit code is 1 if any benchmark is slower than the baseline by more than the tolerance,
+and 2 if there is no baseline to compare with (timings depend on the machine, so none is committed).
+"""
+import argparse
+import itertools
+import json
+import platform
+import random
+import sys
+import timeit
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict
+
+import discord
+
+from main import get_prefix
+from misc.embed import embed_msg, video_embed
+from misc.genius import GeniusSong
+from misc.mixer import FRAME_SIZE, Mixer
+from modules.voice import SongQueue, YTDLSource
+
+BENCHMARKS_DIR = Path(__file__).parent
+BASELINE_FILE = BENCHMARKS_DIR / "baseline.json"
+RESULTS_FILE = BENCHMARKS_DIR / "results.json"
+
+QUEUE_SIZES = (10, 1_000, 100_000)
+
+
+def synthetic_lyrics(paragraphs: int, lines: int, seed: int = 0) -> str:
+    """Lyrics made of paragraphs of pseudo random lines. The same seed always gives the same text."""
+    rng = random.Random(seed)
+    words = ["love", "night", "baby", "fire", "dance", "heart", "tonight", "never", "gonna", "forever"]
+    return "\n\n".join(
+        "\n".join(" ".join(rng.choice(words) for _ in range(rng.randint(4, 10))) for _ in range(lines))
+        for _ in range(paragraphs)
+    )
+
+
+def fake_song(index: int) -> SimpleNamespace:
+    source = SimpleNamespace(title=f"Song {index}",
+                             url=f"https://www.youtube.com/watch?v={index:011d}",
+                             duration=YTDLSource.parse_duration(200 + index % 100),
+                             thumbnail="https://i.ytimg.com/vi/0/hqdefault.jpg")
+    return SimpleNamespace(source=source, requester=SimpleNamespace(mention=f"<@{index}>"))
+
+
+def filled_queue(size: int) -> SongQueue:
+    queue = SongQueue()
+    for i in range(size):
+        queue.put_nowait(fake_song(i))
+    return queue
+
+
+def queue_remove_benchmark(queue: SongQueue) -> Callable:
+    """Remove the middle song and put it back, so the size of the queue doesn't change"""
+    def bench():
+        middle = len(queue) // 2
+        song = queue[middle]
+        queue.remove(middle)
+        queue.put_nowait(song)
+    return bench
+
+
+class EndlessSource(discord.AudioSource):
+    """Returns the same PCM frame forever"""
+
+    def __init__(self, seed: int):
+        rng = random.Random(seed)
+        self.frame = bytes(rng.getrandbits(8) for _ in range(FRAME_SIZE))
+
+    def read(self) -> bytes:
+        return self.frame
+
+
+def mixer_benchmark(overlays: int = 0, ramp: bool = False) -> Callable:
+    """Mix a frame of the main source (and the overlays). With ramp, the volume changes every frame."""
+    mixer = Mixer(EndlessSource(0), volume=0.5)
+    for i in range(overlays):
+        mixer.add(EndlessSource(i + 1), volume=0.5)
+
+    if not ramp:
+        return mixer.read
+
+    volumes = itertools.cycle((0.2, 0.8))
+
+    def bench():
+        mixer.volume = next(volumes)
+        mixer.read()
+    return bench
+
+
+def build_benchmarks() -> Dict[str, Callable]:
+    short_lyrics = synthetic_lyrics(paragraphs=4, lines=4)
+    long_lyrics = synthetic_lyrics(paragraphs=20, lines=400)
+    fields = GeniusSong.split_lyrics(short_lyrics)
+
+    song = fake_song(1)
+    bot = SimpleNamespace(user=SimpleNamespace(id=1234, mention="<@1234>"))
+    guild_message = SimpleNamespace(guild=SimpleNamespace(id=1))
+    dm_message = SimpleNamespace(guild=None)
+
+    benchmarks = {
+        "split_lyrics.short": lambda: GeniusSong.split_lyrics(short_lyrics),
+        "split_lyrics.long": lambda: GeniusSong.split_lyrics(long_lyrics),
+        "parse_duration.minutes": lambda: YTDLSource.parse_duration(245),
+        "parse_duration.days": lambda: YTDLSource.parse_duration(200_000),
+        "embed_msg.fields": lambda: embed_msg(title="Song", footer="Lyrics provided by Genius.",
+                                              field_values=fields),
+        "video_embed": lambda: video_embed(song),
+        "get_prefix.guild": lambda: get_prefix(bot, guild_message),
+        "get_prefix.dm": lambda: get_prefix(bot, dm_message),
+        "mixer.read": mixer_benchmark(),
+        "mixer.read.ramp": mixer_benchmark(ramp=True),
+        "mixer.read.2_overlays": mixer_benchmark(overlays=2),
+    }
+
+    for size in QUEUE_SIZES:
+        queue = filled_queue(size)
+        benchmarks[f"queue.{size}.index"] = lambda q=queue: q[len(q) // 2]
+        benchmarks[f"queue.{size}.slice"] = lambda q=queue: q[len(q) // 2:len(q) // 2 + 10]
+        benchmarks[f"queue.{size}.remove"] = queue_remove_benchmark(queue)
+        benchmarks[f"queue.{size}.shuffle"] = queue.shuffle
+
+    return benchmarks
+
+
+def measure(function: Callable, repeat: int = 5) -> float:
+    """Return the best time per call in seconds"""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> list:
+    """Return the names of the benchmarks slower than the baseline by more than the tolerance"""
+    regressions = []
+    print("\n{:<28}{:>14}{:>14}{:>10}".format("Benchmark", "Baseline", "Current", "Change"))
+    for name, seconds in results.items():
+        if name not in baseline:
+            print("{:<28}{:>14}{:>14.3e}{:>10}".format(name, "-", seconds, "new"))
+            continue
+
+        change = seconds / baseline[name] - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  <-- REGRESSION"
+        print("{:<28}{:>14.3e}{:>14.3e}{:>+9.0%}{}".format(name, baseline[name], seconds, change, flag))
+
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run the bot microbenchmarks.")
+    parser.add_argument("-k", dest="keyword", default="", help="only run the benchmarks containing this keyword")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown before failing, 0.25 means 25%% (default)")
+    parser.add_argument("--output", type=Path, default=RESULTS_FILE, help="where to write the JSON results")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE, help="baseline JSON file")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, function in build_benchmarks().items():
+        if args.keyword in name:
+            results[name] = measure(function)
+            print(f"{name:<28}{results[name]:>14.3e} s")
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    args.output.write_text(json.dumps(report, indent=2))
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    if not args.baseline.exists():
+        print(f"\nFAILED: no baseline found at {args.baseline}, nothing to compare with. "
+              f"Create one on this machine with --save-baseline.")
+        return 2
+
+    baseline = json.loads(args.baseline.read_text())["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\nFAILED: {len(regressions)} benchmark(s) slower than the baseline by more than "
+              f"{args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+
+    print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,9 @@
+import logging
+
 import discord
 from discord.ext import commands
-from misc import auth
+from misc import auth, metrics
+from misc.watchdog import watchdog
 
 """This is a Discord bot created by Ibai Farina (2006)
 """
@@ -23,7 +26,13 @@ def get_prefix(bot_, message):
 
 # Below cogs represents our folder our cogs are in. Following is the file name. So 'example.py' in cogs,
 # would be cogs.example Think of it like a dot path import
-initial_extensions = ['modules.voice']
+initial_extensions = ['modules.voice', 'modules.debug']
+
+# Address of the Prometheus metrics endpoint (http://host:port/metrics), set in config/metrics.json
+METRICS_CONFIG = "config/metrics.json"
+DEFAULT_METRICS_ADDRESS = ("127.0.0.1", 9464)
+
+log = logging.getLogger(__name__)
 
 # Authentication token
 token = auth.authenticate("config/authentication.json", "discord").get("token")
@@ -31,17 +40,44 @@ token = auth.authenticate("config/authentication.json", "discord").get("token")
 bot = commands.Bot(command_prefix=get_prefix, description="Music bot by Zellius")
 
 
+def metrics_address() -> tuple:
+    """(host, port) of the metrics endpoint. The default one is used if the config file is missing."""
+    try:
+        config = auth.authenticate(METRICS_CONFIG, "metrics") or {}
+    except FileNotFoundError:
+        config = {}
+
+    host, port = DEFAULT_METRICS_ADDRESS
+    return config.get("host", host), int(config.get("port", port))
+
+
+async def start_metrics(host: str, port: int):
+    """Serve the metrics. The bot keeps running without them if the address can't be used."""
+    try:
+        await metrics.start_server(host, port)
+    except OSError as e:
+        log.error(f"Couldn't serve the metrics on {host}:{port}: {e}")
+    else:
+        log.info(f"Serving the metrics on http://{host}:{port}/metrics")
+
+
 @bot.event
 async def on_ready():
     """Init bot function"""
-    print(f'Logged in as: {bot.user.name} - {bot.user.id}\nVersion: {discord.__version__}\n')
+    log.info(f'Logged in as: {bot.user.name} - {bot.user.id} Version: {discord.__version__}')
 
     # Changes our bots Playing Status. type=1(streaming) for a standard game you could remove type and url.
     await bot.change_presence(activity=discord.Game(name='!help', type=1, url='https://twitch.tv/astok'))
-    print(f'Successfully logged in and booted...!')
+    log.info('Successfully logged in and booted...!')
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    metrics.instrument_http(bot.http)
+    bot.loop.create_task(start_metrics(*metrics_address()))
+    watchdog.start(bot.loop)
+
     for extension in initial_extensions:
         bot.load_extension(extension)
 
@@ -0,0 +1,230 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+import discord
+
+from misc.metrics import registry
+from misc.playback import FRAME_DELAY, SILENCE, PlaybackStats
+
+"""
+BUFFER
+
+Read-ahead buffer of a playing track.
+A thread reads the frames from ffmpeg ahead of the player. The depth of the buffer adapts to the stream:
+it doubles when the player runs out of frames, grows while the stream is barely faster than real time,
+and shrinks back while the stream is healthy.
+When the stream ends before the track does (expired url, dropped connection), the track is reopened
+at the position already buffered, so the playback continues from where it was instead of restarting.
+"""
+
+log = logging.getLogger(__name__)
+
+AUDIO_UNDERRUNS = registry.counter(
+    "audio_buffer_underruns", "Frames the player found the read-ahead buffer empty")
+AUDIO_RECOVERIES = registry.counter(
+    "audio_stream_recoveries", "Streams reopened after ending before the track", ("result",))
+
+
+class BufferedStream(discord.AudioSource):
+    MIN_FRAMES = 25  # 0.5 s
+    INITIAL_FRAMES = 50  # 1 s
+    MAX_FRAMES = 500  # 10 s
+    # The target shrinks or grows every ADAPT_FRAMES frames read by the player (10 s)
+    ADAPT_FRAMES = 500
+    # Failed reopens in a row before giving up
+    MAX_RECOVERIES = 3
+    # A stream ending this close to the duration of the track is the end of the track
+    END_TOLERANCE = 2.0
+
+    def __init__(self,
+                 source: discord.AudioSource,
+                 *,
+                 reopen: Optional[Callable[[float], discord.AudioSource]] = None,
+                 duration: Optional[float] = None,
+                 stats: Optional[PlaybackStats] = None):
+        """
+        :param source: the stream (e.g. discord.FFmpegPCMAudio)
+        :param reopen: called (in the buffer thread) with a position in seconds, it returns a new stream
+                       starting there. Without it, the stream isn't reopened.
+        :param duration: the duration of the track in seconds, if known
+        :param stats: the stats of the track. The reads of the stream, the underruns and the recoveries
+                      are added to them. Without them, nothing is recorded (e.g. the overlays of the Mixer).
+        """
+        self.source = source
+        self.reopen = reopen
+        self.duration = duration
+        self.stats = stats
+
+        self.target = self.INITIAL_FRAMES
+        self.frames: deque = deque()
+        self.position = 0.0  # Seconds buffered since the start of the track
+        self.underruns = 0
+        self.recoveries = 0
+
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._finished = False
+        self._closed = False
+        self._reads = 0
+        # Whether the buffer reached its target since it was last deepened
+        self._refilled = True
+        self._underruns_since_adapt = 0
+        # Average time ffmpeg takes to give a frame, while the buffer is filling
+        self._fetch_time = FRAME_DELAY / 2
+
+    @property
+    def depth(self) -> int:
+        return len(self.frames)
+
+    @property
+    def ready(self) -> bool:
+        """Whether read() returns without waiting: a frame is buffered or the stream is over"""
+        return bool(self.frames) or self._finished or self._closed
+
+    @property
+    def throughput(self) -> float:
+        """How many times faster than real time the stream delivers"""
+        return FRAME_DELAY / max(self._fetch_time, 1e-6)
+
+    def _fill(self):
+        # Reopens in a row that didn't give a frame yet
+        failures = 0
+        while True:
+            with self._condition:
+                while len(self.frames) >= self.target and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                source = self.source
+
+            start = time.perf_counter()
+            try:
+                data = source.read()
+            except (AttributeError, OSError, ValueError):
+                # The stream was cleaned up while being read
+                data = b''
+            read_time = time.perf_counter() - start
+            self._fetch_time = 0.95 * self._fetch_time + 0.05 * read_time
+
+            if data:
+                if self.stats is not None:
+                    self.stats.record_read(read_time, data)
+
+                if failures:
+                    # The reopened stream works, the recovery is over
+                    failures = 0
+                    AUDIO_RECOVERIES.inc(labels=("ok",))
+                    self.recoveries += 1
+                    if self.stats is not None:
+                        self.stats.recoveries += 1
+
+                with self._condition:
+                    self.frames.append(data)
+                    self.position += FRAME_DELAY
+                    if len(self.frames) >= self.target:
+                        self._refilled = True
+                    self._condition.notify_all()
+                continue
+
+            if self._closed or self._ended() or self.reopen is None:
+                break
+
+            # The stream ended before the track, reopen it where it stopped
+            source.cleanup()
+            if failures >= self.MAX_RECOVERIES:
+                AUDIO_RECOVERIES.inc(labels=("failed",))
+                log.error(f"Giving up on the stream after {self.MAX_RECOVERIES} failed reopens")
+                break
+            if failures:
+                # The last reopen didn't work, give the server some time
+                time.sleep(min(2 ** failures * 0.5, 5))
+            failures += 1
+
+            log.warning(f"Stream ended at {self.position:.1f}s of {self.duration}s, reopening it")
+            try:
+                new_source = self.reopen(self.position)
+            except Exception as e:
+                log.warning(f"Couldn't reopen the stream: {e}")
+                continue
+
+            with self._condition:
+                self.source = new_source
+                closed = self._closed
+            if closed:
+                new_source.cleanup()
+                break
+
+        with self._condition:
+            self._finished = True
+            self._condition.notify_all()
+
+    def _ended(self) -> bool:
+        return self.duration is not None and self.position >= self.duration - self.END_TOLERANCE
+
+    def _adapt(self):
+        """Called by the player every ADAPT_FRAMES frames"""
+        if self._underruns_since_adapt == 0 and self.throughput > 2:
+            self.target = max(self.MIN_FRAMES, self.target - self.target // 4)
+        elif self.throughput < 1.2:
+            self.target = min(self.MAX_FRAMES, self.target + self.INITIAL_FRAMES)
+        self._underruns_since_adapt = 0
+
+    def start(self):
+        """Start reading ahead, without waiting for the first frame"""
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._fill, name="audio-buffer", daemon=True)
+                self._thread.start()
+
+    def read(self) -> bytes:
+        if self._thread is None:
+            self.start()
+            with self._condition:
+                # Wait for the stream to start, like a direct read from ffmpeg would
+                self._condition.wait_for(lambda: self.ready)
+
+        with self._condition:
+            if not self.ready:
+                # Give the reader a moment before giving up on this frame
+                self._condition.wait_for(lambda: self.ready, timeout=FRAME_DELAY / 4)
+
+            if self.frames:
+                data = self.frames.popleft()
+                self._condition.notify_all()
+            elif self._finished or self._closed:
+                return b''
+            else:
+                # Underrun: keep the pace with silence and read further ahead from now on
+                data = SILENCE
+                self.underruns += 1
+                if self.stats is not None:
+                    self.stats.underruns += 1
+                self._underruns_since_adapt += 1
+                AUDIO_UNDERRUNS.inc()
+                if self._refilled:
+                    # Deepen it once, then give the stream a chance to fill the new depth
+                    self._refilled = False
+                    self.target = min(self.MAX_FRAMES, self.target * 2)
+
+            self._reads += 1
+            if self._reads % self.ADAPT_FRAMES == 0:
+                self._adapt()
+                self._condition.notify_all()
+
+        return data
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self):
+        with self._condition:
+            self._closed = True
+            self.frames.clear()
+            self._condition.notify_all()
+            source = self.source
+
+        # Ends the read of the buffer thread too
+        source.cleanup()
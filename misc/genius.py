@@ -1,5 +1,6 @@
+from collections import OrderedDict
 from difflib import SequenceMatcher
-from typing import Union, Optional
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 import lyricsgenius
 import requests
@@ -8,6 +9,9 @@ from misc import auth
 
 
 class GeniusSong:
+    # Base url of the Genius API
+    BASE_URL = "http://api.genius.com"
+
     def __init__(self, song, artist=None):
         """This class lets you get info of a song using the Genius API.
         """
@@ -15,7 +19,7 @@ class GeniusSong:
         self.genius_token = auth.authenticate("config/authentication.json", "apis").get("genius_token")
         self.headers = {'Authorization': 'Bearer ' + self.genius_token}
         # Base url
-        self.base_url = "http://api.genius.com"
+        self.base_url = self.BASE_URL
 
         self.song = song
         self.artist = artist
@@ -49,27 +53,27 @@ class GeniusSong:
 
     def return_similar_artist(self, response: dict, min_similarity: float = 0.7) -> Union[str, bool]:
         """Filter hits by an artist.
+        Every hit is scored and the best ranked one is returned.
         If there is some error or the similarity is not met, then return False.
         :response: the dictionary containing all the hits
         :min_similarity: the min relationship between the found artist on the hit and the artist of YouTube.
         """
+        if not self.artist:
+            return False
+
         try:
-            for hit in response["response"]["hits"]:
-                name = hit["result"]["primary_artist"]["name"]
-                # Find the similarity between strings
-                string_similarity = SequenceMatcher(None, name.lower(), self.artist.lower()).ratio()
+            hits = response["response"]["hits"]
+        except (KeyError, TypeError):
+            return False
 
-                # Print info
-                print("\n{:<12}{:<30}{:<30}".format("Score", "Genius Artist", "YouTube Artist"))
-                print("{:<12.2f}{:<30}{:<30}".format(string_similarity, name, self.artist))
+        return artist_matcher.match(hits, self.artist, self.song, min_similarity)
 
-                if string_similarity > min_similarity:
-                    return name
-                else:
-                    return False
+    def known_artist(self) -> Optional[str]:
+        """The Genius artist matched before for the YouTube artist, if any. Check it before searching."""
+        if not self.artist:
+            return None
 
-        except KeyError:
-            return False
+        return artist_matcher.known(self.artist)
 
     @staticmethod
     def split_lyrics(lyrics: str) -> list[dict[str, str]]:
@@ -100,3 +104,123 @@ class GeniusSong:
                         current_line = line + "\n"
 
         return fields
+
+
+class ArtistMatcher:
+    """Ranks Genius hits against a YouTube artist and song title.
+    Hits are scored in a single pass. A cheap trigram overlap discards the unrelated hits
+    before the (expensive) SequenceMatcher ratios are computed.
+    Resolved YouTube artists are memoized (see known), so repeated lookups don't have to search or score anything.
+    """
+
+    def __init__(self, min_overlap: float = 0.1, artist_weight: float = 0.7, max_known: int = 1024):
+        """
+        :param min_overlap: the min trigram overlap (0 to 1) a hit needs to be scored.
+        :param artist_weight: the weight of the artist similarity in the rank. The title takes the rest.
+        :param max_known: the number of resolved artists kept. The least recently used are dropped.
+        """
+        self.min_overlap = min_overlap
+        self.artist_weight = artist_weight
+        self.max_known = max_known
+        # YouTube uploader/artist -> Genius artist, the least recently used first
+        self.known_artists: Dict[str, str] = OrderedDict()
+        # The matcher caches the analysis of its second sequence, so this one is reused between hits
+        self._matcher = SequenceMatcher(None)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.lower().split())
+
+    @staticmethod
+    def trigrams(text: str) -> Set[str]:
+        """Return the set of character trigrams of an (already normalized) string"""
+        text = f"  {text} "
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @staticmethod
+    def overlap(a: Set[str], b: Set[str]) -> float:
+        """Jaccard index of two sets"""
+        if not a or not b:
+            return 0.0
+        return len(a & b) / len(a | b)
+
+    def _ratios(self, target: str, candidates: List[str]) -> List[float]:
+        """Similarity of every candidate with the target, analysing the target only once"""
+        self._matcher.set_seq2(target)
+        ratios = []
+        for candidate in candidates:
+            self._matcher.set_seq1(candidate)
+            ratios.append(self._matcher.ratio())
+        return ratios
+
+    def rank(self, hits: List[dict], artist: str, title: str = "") -> List[Tuple[float, float, str]]:
+        """Score all the hits.
+        :param hits: the hits of a Genius search response
+        :param artist: the artist listed on YouTube
+        :param title: the song title listed on YouTube
+        :return: (score, artist similarity, Genius artist) tuples, best first. Filtered hits are left out.
+        """
+        artist = self.normalize(artist)
+        title = self.normalize(title or "")
+        artist_grams = self.trigrams(artist)
+
+        names, titles = [], []
+        for hit in hits:
+            try:
+                result = hit["result"]
+                name = result["primary_artist"]["name"]
+            except (KeyError, TypeError):
+                continue
+
+            if not name or self.overlap(artist_grams, self.trigrams(self.normalize(name))) < self.min_overlap:
+                continue
+
+            names.append(name)
+            titles.append(self.normalize(result.get("title") or ""))
+
+        if not names:
+            return []
+
+        artist_ratios = self._ratios(artist, [self.normalize(name) for name in names])
+        title_ratios = self._ratios(title, titles) if title else [0.0] * len(names)
+        title_weight = 1 - self.artist_weight if title else 0.0
+
+        ranked = [
+            (self.artist_weight * artist_ratio + title_weight * title_ratio, artist_ratio, name)
+            for name, artist_ratio, title_ratio in zip(names, artist_ratios, title_ratios)
+        ]
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        return ranked
+
+    def known(self, artist: str) -> Optional[str]:
+        """Return the Genius artist resolved before for a YouTube artist, or None"""
+        key = self.normalize(artist)
+        name = self.known_artists.get(key)
+        if name is not None:
+            self.known_artists.move_to_end(key)
+        return name
+
+    def remember(self, artist: str, name: str):
+        """Memoize the Genius artist of a YouTube artist"""
+        key = self.normalize(artist)
+        self.known_artists[key] = name
+        self.known_artists.move_to_end(key)
+        while len(self.known_artists) > self.max_known:
+            self.known_artists.popitem(last=False)
+
+    def match(self, hits: List[dict], artist: str, title: str = "", min_similarity: float = 0.7) -> Union[str, bool]:
+        """Return the Genius artist of the best ranked hit, or False if no artist is similar enough"""
+        name = self.known(artist)
+        if name is not None:
+            return name
+
+        for _score, artist_similarity, name in self.rank(hits, artist, title):
+            if artist_similarity > min_similarity:
+                self.remember(artist, name)
+                return name
+
+        return False
+
+
+# Shared by all the GeniusSong instances, so the known artists are kept between commands
+artist_matcher = ArtistMatcher()
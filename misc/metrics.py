@@ -0,0 +1,219 @@
+import bisect
+import functools
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from aiohttp import web
+
+"""
+METRICS
+
+A small metrics registry served in the Prometheus text format.
+Observing a value only takes a lock and a couple of additions, so it can be used in the audio thread.
+Values that are cheap to compute when scraped (e.g. queue lengths) should use a Gauge with a function instead.
+"""
+
+LabelValues = Tuple[str, ...]
+
+# Seconds. From a few milliseconds (frames, sends) to tens of seconds (extraction of long playlists)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    labels = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    )
+    return "{" + labels + "}" if labels else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def samples(self) -> List[Tuple[str, LabelValues, float, Tuple[str, ...]]]:
+        """(name suffix, label values, value, extra label names) of every sample"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value, extra_names in self.samples():
+            names = self.labelnames + extra_names
+            lines.append(f"{self.name}{suffix}{_format_labels(names, labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        if not name.endswith("_total"):
+            name += "_total"
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, labels: LabelValues = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [("", labels, value, ()) for labels, value in self._values.items()]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Tuple[str, ...] = (),
+                 function: Optional[Callable[[], Dict[LabelValues, float]]] = None):
+        """
+        :param function: called on every scrape, it returns the values by label values.
+        """
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, labels: LabelValues = ()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, amount: float = 1, labels: LabelValues = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, labels: LabelValues = ()):
+        self.inc(-amount, labels)
+
+    def samples(self):
+        if self.function is not None:
+            return [("", labels, value, ()) for labels, value in self.function().items()]
+
+        with self._lock:
+            return [("", labels, value, ()) for labels, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> [count of every bucket (not cumulative) + the +Inf bucket, sum]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, labels: LabelValues = ()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+
+        samples = []
+        for labels, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", labels + (_format_value(bound),), cumulative, ("le",)))
+            samples.append(("_count", labels, cumulative, ()))
+            samples.append(("_sum", labels, counts[-1], ()))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric. A metric with the same name is replaced (e.g. when an extension is reloaded)"""
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), function=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self,
+                  name: str,
+                  documentation: str,
+                  labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """All the metrics in the Prometheus text format"""
+        return "\n".join(metric.render() for metric in list(self._metrics.values())) + "\n"
+
+
+# Default registry used by the bot
+registry = Registry()
+
+DISCORD_REQUEST_SECONDS = registry.histogram(
+    "discord_request_seconds",
+    "Duration of the requests to the Discord HTTP API. Sent messages are POST /channels/{channel_id}/messages",
+    ("method", "route")
+)
+
+
+def instrument_http(http):
+    """Observe the duration of every request done by a discord.http.HTTPClient.
+    Only this instance is wrapped.
+    :param http: the bot.http client
+    """
+    request = http.request
+
+    @functools.wraps(request)
+    async def timed_request(route, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await request(route, **kwargs)
+        finally:
+            DISCORD_REQUEST_SECONDS.observe(time.perf_counter() - start, (route.method, route.path))
+
+    http.request = timed_request
+
+
+async def start_server(host: str = "127.0.0.1", port: int = 9464, registry_: Registry = registry) -> web.AppRunner:
+    """Serve the metrics in http://host:port/metrics
+    :return: the runner, call its cleanup() to stop the server
+    """
+    async def handle(_request: web.Request) -> web.Response:
+        return web.Response(body=registry_.render().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
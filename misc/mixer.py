@@ -0,0 +1,164 @@
+import ctypes
+import threading
+from typing import Optional, Tuple
+
+import discord
+import numpy as np
+from discord.opus import Encoder
+
+from misc.buffer import BufferedStream
+
+"""
+MIXER
+
+Mixes the song of a guild with short overlay sources (sound effects, announcements) and applies the volume.
+The PCM frames are processed as NumPy buffers allocated once per mixer, so reading a 20 ms frame allocates
+no new frame buffer. Volume changes take effect in the next frame, ramped to avoid clicks.
+The overlays are read ahead in their own threads: one that is still connecting or that stalls
+adds nothing to the frame instead of delaying the song.
+"""
+
+FRAME_SIZE = Encoder.FRAME_SIZE  # Bytes of a 20 ms 16-bit stereo frame
+SAMPLES = FRAME_SIZE // 2  # Samples of both channels
+
+
+class Overlay:
+    def __init__(self, source: discord.AudioSource, volume: float):
+        self.source = BufferedStream(source)
+        self.volume = volume
+
+
+class Mixer(discord.AudioSource):
+    """
+    Plays a source, mixing the overlays over it.
+    The playback ends with the main source. The overlays end by themselves.
+    """
+    MAX_OVERLAYS = 4
+
+    def __init__(self, source: Optional[discord.AudioSource] = None, *, volume: float = 1.0, ramp_frames: int = 5):
+        """
+        :param source: the main source
+        :param volume: the volume of the mix (1.0 is 100%, up to 2.0)
+        :param ramp_frames: number of frames a volume change from 0% to 100% takes
+        """
+        self.source = source
+        self._volume = self._gain = self._clamp(volume)
+        self.ramp_step = 1 / max(ramp_frames, 1)
+
+        # The overlays are replaced (never mutated) so the player thread can read them without the lock
+        self._overlays: Tuple[Overlay, ...] = ()
+        self._lock = threading.Lock()
+
+        # Buffers of every frame
+        self._mix = np.zeros(SAMPLES, dtype=np.float32)
+        self._input = np.zeros(SAMPLES, dtype=np.float32)
+        self._gains = np.zeros(SAMPLES, dtype=np.float32)
+        # Per sample position inside the frame (0, 1], the same for both channels of a sample
+        self._ramp = np.repeat(np.arange(1, SAMPLES // 2 + 1, dtype=np.float32) / (SAMPLES // 2), 2)
+        # The returned frame. The encoder reads it before the next frame is mixed.
+        self._frame = (ctypes.c_char * FRAME_SIZE)()
+        self._frame_samples = np.frombuffer(self._frame, dtype=np.int16)
+
+    @staticmethod
+    def _clamp(volume: float) -> float:
+        return min(max(volume, 0.0), 2.0)
+
+    @property
+    def volume(self) -> float:
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self._volume = self._clamp(value)
+
+    @property
+    def overlays(self) -> int:
+        return len(self._overlays)
+
+    def add(self, source: discord.AudioSource, volume: float = 1.0):
+        """Mix a source over the main one until it ends.
+        The source is read ahead by the mixer, it shouldn't be buffered already (e.g. a plain FFmpegPCMAudio).
+        """
+        if source.is_opus():
+            raise discord.ClientException('AudioSource must not be Opus encoded.')
+
+        with self._lock:
+            if len(self._overlays) >= self.MAX_OVERLAYS:
+                raise discord.ClientException(f'There are already {self.MAX_OVERLAYS} sounds playing.')
+            overlay = Overlay(source, volume)
+            self._overlays += (overlay,)
+
+        overlay.source.start()
+
+    def _remove(self, overlay: Overlay):
+        with self._lock:
+            self._overlays = tuple(item for item in self._overlays if item is not overlay)
+        overlay.source.cleanup()
+
+    def _load(self, data: bytes, buffer: np.ndarray):
+        """Copy a PCM frame to a buffer, padding short frames with silence"""
+        samples = np.frombuffer(data, dtype=np.int16, count=len(data) // 2)
+        count = len(samples)
+        np.copyto(buffer[:count], samples, casting='unsafe')
+        if count < SAMPLES:
+            buffer[count:] = 0
+
+    def _apply_volume(self):
+        start = self._gain
+        step = min(max(self._volume - start, -self.ramp_step), self.ramp_step)
+        self._gain = start + step
+
+        if step == 0:
+            if start != 1.0:
+                np.multiply(self._mix, start, out=self._mix)
+            return
+
+        # Linear ramp from the gain of the previous frame to the new one
+        np.multiply(self._ramp, step, out=self._gains)
+        np.add(self._gains, start, out=self._gains)
+        np.multiply(self._mix, self._gains, out=self._mix)
+
+    def read(self):
+        if self.source is None:
+            return b''
+
+        data = self.source.read()
+        if not data:
+            return b''
+
+        self._load(data, self._mix)
+
+        for overlay in self._overlays:
+            if not overlay.source.ready:
+                continue
+
+            overlay_data = overlay.source.read()
+            if not overlay_data:
+                self._remove(overlay)
+                continue
+
+            self._load(overlay_data, self._input)
+            if overlay.volume != 1.0:
+                np.multiply(self._input, overlay.volume, out=self._input)
+            np.add(self._mix, self._input, out=self._mix)
+
+        self._apply_volume()
+
+        np.clip(self._mix, -32768, 32767, out=self._mix)
+        np.copyto(self._frame_samples, self._mix, casting='unsafe')
+        return self._frame
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        """Clean up the main source and the overlays. The mixer can be reused with another source."""
+        with self._lock:
+            overlays, self._overlays = self._overlays, ()
+
+        for overlay in overlays:
+            overlay.source.cleanup()
+
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
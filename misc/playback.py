@@ -0,0 +1,156 @@
+import logging
+import os
+import threading
+from collections import deque
+from typing import Optional
+
+from discord.opus import Encoder
+
+from misc.metrics import registry
+
+"""
+PLAYBACK
+
+Frame pacing and underrun instrumentation of the audio path.
+
+ffmpeg is read ahead of the player by misc.buffer.BufferedStream, which times every read of the stream
+(record_read). The player thread takes a frame from the buffer every 20 ms (record_frame):
+  - when the buffer is empty, the stream couldn't keep up (network underrun, slow CDN, reconnect)
+  - when a frame comes too long after the previous one, the player thread wasn't scheduled in time
+    (CPU starvation), since taking a frame from the buffer doesn't wait for the network
+"""
+
+log = logging.getLogger(__name__)
+
+FRAME_DELAY = Encoder.FRAME_LENGTH / 1000.0
+SILENCE = b"\0" * Encoder.FRAME_SIZE
+
+# Lateness allowed before a frame counts as late
+LATE_TOLERANCE = 0.01
+# Longer gaps are pauses, not late frames
+PAUSE_THRESHOLD = 1.0
+
+AUDIO_READ_SECONDS = registry.histogram(
+    "audio_frame_read_seconds", "Time to read a 20 ms PCM frame from ffmpeg, in the buffer thread",
+    buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5, 1.0))
+AUDIO_INTERVAL_SECONDS = registry.histogram(
+    "audio_frame_interval_seconds", "Time between two frame reads of the player",
+    buckets=(0.015, 0.019, 0.021, 0.025, 0.03, 0.05, 0.1, 0.5, 1.0))
+AUDIO_LATE_FRAMES = registry.counter(
+    "audio_late_frames", "Frames the player thread read late (CPU starvation)")
+AUDIO_SILENT_FRAMES = registry.counter(
+    "audio_silent_frames", "Frames of digital silence read from ffmpeg (not the underruns of the buffer)")
+FFMPEG_RECONNECTS = registry.counter(
+    "ffmpeg_reconnects", "Reconnections of ffmpeg to the stream")
+
+
+class PlaybackStats:
+    """Frame pacing stats of a track. Updated by the buffer and player threads, read by the commands."""
+
+    def __init__(self, history: int = 3000):
+        """
+        :param history: number of recent ffmpeg read times kept for the percentiles (3000 frames = 1 minute)
+        """
+        self.frames = 0
+        self.late_frames = 0
+        self.silent_frames = 0
+        self.reconnects = 0
+        # Updated by misc.buffer.BufferedStream
+        self.underruns = 0
+        self.recoveries = 0
+        self.read_times: deque = deque(maxlen=history)
+        self._last_read: Optional[float] = None
+
+    def record_read(self, read_time: float, data: bytes):
+        """Record a read of the stream (in the buffer thread).
+        :param read_time: seconds the read took
+        :param data: the frame
+        """
+        self.read_times.append(read_time)
+        AUDIO_READ_SECONDS.observe(read_time)
+
+        if data == SILENCE:
+            self.silent_frames += 1
+            AUDIO_SILENT_FRAMES.inc()
+
+    def record_frame(self, end: float):
+        """Record a frame taken by the player.
+        :param end: perf_counter after the frame was read
+        """
+        self.frames += 1
+
+        if self._last_read is not None:
+            interval = end - self._last_read
+            AUDIO_INTERVAL_SECONDS.observe(interval)
+
+            if FRAME_DELAY + LATE_TOLERANCE < interval < PAUSE_THRESHOLD:
+                self.late_frames += 1
+                AUDIO_LATE_FRAMES.inc()
+
+        self._last_read = end
+
+    def reconnected(self):
+        self.reconnects += 1
+        FFMPEG_RECONNECTS.inc()
+
+    def read_time_percentile(self, percent: float) -> float:
+        times = sorted(self.read_times)
+        if not times:
+            return 0.0
+        return times[min(len(times) - 1, int(len(times) * percent / 100))]
+
+    @property
+    def diagnosis(self) -> str:
+        if not self.frames or (self.late_frames + self.underruns) / self.frames < 0.001:
+            return "Smooth"
+        if self.underruns >= self.late_frames:
+            return "Network underruns"
+        return "CPU starvation"
+
+
+def watch_ffmpeg_log(fd: int, stats: PlaybackStats):
+    """Read the log of ffmpeg in a daemon thread, counting the reconnections.
+    ffmpeg should be started with "-loglevel warning -nostats", so that only the problems are logged.
+    The thread ends when ffmpeg exits.
+    :param fd: read end of the pipe ffmpeg writes its stderr to
+    :param stats: the stats of the track
+    """
+    def watch():
+        with os.fdopen(fd, "rb") as pipe:
+            for line in pipe:
+                line = line.decode(errors="replace").rstrip()
+                # -reconnect logs "Will reconnect at <offset> in <n> second(s), error=<error>."
+                if "reconnect" in line.lower():
+                    stats.reconnected()
+                    log.warning(f"ffmpeg: {line}")
+                else:
+                    # The other warnings usually contain the stream url
+                    log.debug(f"ffmpeg: {line}")
+
+    threading.Thread(target=watch, name="ffmpeg-log", daemon=True).start()
+
+
+def format_stats(stats: PlaybackStats, buffer=None) -> list:
+    """Fields for misc.embed.embed_msg
+    :param stats: the stats of the track
+    :param buffer: the misc.buffer.BufferedStream of the track, if any
+    """
+    played = stats.frames * FRAME_DELAY
+    fields = [
+        {"name": "Played", "value": f"{played:.0f} s ({stats.frames} frames)"},
+        {"name": "ffmpeg read", "value": f"p50 {stats.read_time_percentile(50) * 1000:.2f} ms\n"
+                                        f"p99 {stats.read_time_percentile(99) * 1000:.2f} ms\n"
+                                        f"max {stats.read_time_percentile(100) * 1000:.2f} ms"},
+        {"name": "Late frames", "value": str(stats.late_frames)},
+        {"name": "Silent frames", "value": str(stats.silent_frames)},
+        {"name": "ffmpeg reconnects", "value": str(stats.reconnects)},
+        {"name": "Diagnosis", "value": stats.diagnosis},
+    ]
+
+    if buffer is not None:
+        fields.insert(-1, {"name": "Buffer", "value": f"{buffer.depth}/{buffer.target} frames\n"
+                                                     f"{buffer.throughput:.1f}x real time"})
+        fields.insert(-1, {"name": "Underruns", "value": f"{stats.underruns} frames\n"
+                                                        f"{stats.recoveries} stream recoveries"})
+
+    return fields
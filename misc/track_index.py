@@ -0,0 +1,99 @@
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+
+class TrackIndex:
+    """Local full-text index of the tracks that have already been resolved.
+    It uses SQLite FTS5 over the title, track, artist and uploader of each track,
+    so a query that was played before can be answered without a remote search.
+    """
+    FIELDS = ('title', 'track', 'artist', 'uploader')
+    # Decorations of video titles, they don't tell one track from another
+    NOISE_WORDS = {'official', 'music', 'video', 'audio', 'lyrics', 'lyric', 'hd', 'hq', '4k', 'remastered',
+                   'remaster', 'mv', 'ft', 'feat'}
+    # Shorter queries are too generic to be answered locally
+    MIN_QUERY_WORDS = 2
+
+    def __init__(self, filename: Union[Path, str] = ":memory:"):
+        """
+        :param filename: path to the SQLite database. By default the index is only kept in memory.
+        """
+        # The connection is shared with the executor threads, access is serialized with the lock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(filename), check_same_thread=False)
+        self._db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS tracks USING fts5("
+            "webpage_url UNINDEXED, title, track, artist, uploader)"
+        )
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT count(*) FROM tracks").fetchone()[0]
+
+    @staticmethod
+    def tokenize(text: str) -> list:
+        return re.findall(r"\w+", text.lower())
+
+    @classmethod
+    def words(cls, text: str) -> set:
+        """The words of a text that can identify a track"""
+        return set(cls.tokenize(text)) - cls.NOISE_WORDS
+
+    def add(self, info: dict):
+        """Add (or replace) a resolved track.
+        :param info: the processed youtube_dl info of the track
+        """
+        webpage_url = info.get('webpage_url')
+        if not webpage_url:
+            return
+
+        # The stream url expires, and the track is extracted again to play it anyway.
+        # Only the webpage url and the searchable fields are kept.
+        with self._lock:
+            self._db.execute("DELETE FROM tracks WHERE webpage_url = ?", (webpage_url,))
+            self._db.execute(
+                "INSERT INTO tracks (webpage_url, title, track, artist, uploader) VALUES (?, ?, ?, ?, ?)",
+                (webpage_url, *(info.get(field) or "" for field in self.FIELDS))
+            )
+            self._db.commit()
+
+    def search(self, query: str, limit: int = 10) -> Optional[Tuple[float, str]]:
+        """Find the best local match for a query.
+        The confidence is the fraction of the query words found in the track, times the fraction of the name
+        of the track (its title, its track name or its track name and artist) covered by the query.
+        A generic query matching a long title only partially (e.g. the artist alone) gets a low confidence.
+        :param query: the free-text query
+        :param limit: the number of FTS candidates to check
+        :return: (confidence, webpage url) or None if nothing matches
+        """
+        tokens = self.words(query)
+        if len(tokens) < self.MIN_QUERY_WORDS:
+            return None
+
+        match = " OR ".join(f'"{token}"' for token in tokens)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT webpage_url, title, track, artist, uploader FROM tracks WHERE tracks MATCH ? "
+                "ORDER BY rank LIMIT ?",
+                (match, limit)
+            ).fetchall()
+
+        best = None
+        for webpage_url, title, track, artist, uploader in rows:
+            found = tokens & self.words(" ".join((title, track, artist, uploader)))
+            names = [self.words(name) for name in (title, track, f"{track} {artist}") if name.strip()]
+            covered = max((len(found & name) / len(name) for name in names if name), default=0.0)
+
+            confidence = len(found) / len(tokens) * covered
+            if best is None or confidence > best[0]:
+                best = (confidence, webpage_url)
+
+        return best
+
+    def close(self):
+        with self._lock:
+            self._db.close()
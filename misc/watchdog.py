@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from misc.metrics import registry
+
+"""
+WATCHDOG
+
+Measures the event loop lag continuously.
+A thread checks the heartbeat of the loop. When the loop stalls for longer than the threshold,
+the thread captures the stack of the code that is blocking it, and the stall is attributed
+to the command and guild of the task that was running (see LoopWatchdog.tag).
+"""
+
+log = logging.getLogger(__name__)
+
+LOOP_LAG_SECONDS = registry.histogram(
+    "event_loop_lag_seconds", "Delay of the event loop heartbeat",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+LOOP_STALLS = registry.counter(
+    "event_loop_stalls", "Event loop stalls longer than the watchdog threshold", ("command",))
+
+# The frames of this directory are the ones used to attribute a stall
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Stall:
+    def __init__(self, duration: float, command: str, guild: Optional[int], location: str, stack: str):
+        self.duration = duration
+        self.command = command
+        self.guild = guild
+        self.location = location
+        self.stack = stack
+        self.time = time.time()
+
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = 0.1, interval: float = 0.05, history: int = 200):
+        """
+        :param threshold: seconds the loop must be blocked to capture a stall
+        :param interval: seconds between heartbeats
+        :param history: number of recent stalls kept for the summary
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls: deque = deque(maxlen=history)
+
+        self.loop = None
+        self._loop_thread_id = None
+        self._last_beat = time.perf_counter()
+        self._pending: Optional[Tuple[str, Optional[int], str, str]] = None
+        self._stopped = threading.Event()
+        # Task -> (command, guild id)
+        self._tags = weakref.WeakKeyDictionary()
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """Start the heartbeat in the loop and the watchdog thread"""
+        self.loop = loop
+        self._stopped.clear()
+        loop.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def tag(self, command: str, guild: Optional[int] = None, task: Optional[asyncio.Task] = None):
+        """Attribute the stalls caused by a task (the current one by default) to a command and guild"""
+        task = task or asyncio.current_task()
+        if task is not None:
+            self._tags[task] = (command, guild)
+
+    async def _heartbeat(self):
+        self._loop_thread_id = threading.get_ident()
+        while not self._stopped.is_set():
+            self._last_beat = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - self._last_beat - self.interval
+            LOOP_LAG_SECONDS.observe(max(lag, 0.0))
+
+            if self._pending is not None and lag > self.threshold:
+                self._record(lag, *self._pending)
+            self._pending = None
+
+    def _watch(self):
+        while not self._stopped.wait(self.threshold / 2):
+            blocked = time.perf_counter() - self._last_beat - self.interval
+            if blocked > self.threshold and self._pending is None:
+                self._pending = self._capture()
+
+    def _capture(self) -> Tuple[str, Optional[int], str, str]:
+        """(command, guild, location, stack) of the code blocking the loop"""
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return "unknown", None, "unknown", ""
+
+        stack = traceback.extract_stack(frame)
+        # Only keep the frames of the running coroutine, after the loop called its handle
+        for index in range(len(stack) - 1, -1, -1):
+            if stack[index].filename.endswith(os.path.join("asyncio", "events.py")):
+                stack = traceback.StackSummary.from_list(stack[index + 1:])
+                break
+        location = self._location(stack)
+
+        task = asyncio.current_task(self.loop)
+        command, guild = self._tags.get(task, ("unknown", None)) if task is not None else ("unknown", None)
+        return command, guild, location, "".join(stack.format())
+
+    @staticmethod
+    def _location(stack: traceback.StackSummary) -> str:
+        """The innermost frame of the bot's own code (or the innermost frame if there is none)"""
+        for entry in reversed(stack):
+            if entry.filename.startswith(PROJECT_ROOT) and "site-packages" not in entry.filename:
+                return f"{os.path.relpath(entry.filename, PROJECT_ROOT)}:{entry.lineno} in {entry.name}"
+
+        if not stack:
+            return "unknown"
+
+        entry = stack[-1]
+        return f"{entry.filename}:{entry.lineno} in {entry.name}"
+
+    def _record(self, duration: float, command: str, guild: Optional[int], location: str, stack: str):
+        self.stalls.append(Stall(duration, command, guild, location, stack))
+        LOOP_STALLS.inc(labels=(command,))
+        log.warning(f"Event loop blocked for {duration * 1000:.0f} ms by command '{command}' "
+                    f"in guild {guild} at {location}\n{stack}")
+
+    def worst_offenders(self, limit: int = 10) -> List[Dict]:
+        """Recent stalls grouped by command and location, the longest total duration first"""
+        groups = {}
+        for stall in list(self.stalls):
+            group = groups.setdefault((stall.command, stall.location), {
+                "command": stall.command, "location": stall.location, "count": 0, "total": 0.0, "max": 0.0,
+                "guilds": set()
+            })
+            group["count"] += 1
+            group["total"] += stall.duration
+            group["max"] = max(group["max"], stall.duration)
+            if stall.guild is not None:
+                group["guilds"].add(stall.guild)
+
+        return sorted(groups.values(), key=lambda group: group["total"], reverse=True)[:limit]
+
+
+# Shared by the bot and the cogs
+watchdog = LoopWatchdog()
@@ -0,0 +1,55 @@
+from discord.ext import commands
+
+from misc.embed import embed_msg
+from misc.watchdog import watchdog
+
+"""
+DEBUG MODULE
+
+Owner only commands to inspect the bot.
+
+The commands include:
+  stalls  Shows the commands and code that blocked the event loop the longest.
+"""
+
+
+class Debug(commands.Cog):
+    """
+    Commands for the owner of the bot.
+    """
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
+        await ctx.send(str(error))
+
+    @commands.command(name='stalls')
+    @commands.is_owner()
+    async def _stalls(self, ctx: commands.Context, *, limit: int = 5):
+        """Shows the commands and code that blocked the event loop the longest.
+        The stalls are grouped by command and location, the longest total first.
+        """
+        offenders = watchdog.worst_offenders(limit)
+        if not offenders:
+            return await ctx.send(f"No event loop stalls longer than {watchdog.threshold * 1000:.0f} ms.")
+
+        fields = [
+            {
+                "name": f"{offender['command']} ({offender['count']}x)",
+                "value": f"`{offender['location']}`\n"
+                         f"Total {offender['total'] * 1000:.0f} ms, max {offender['max'] * 1000:.0f} ms, "
+                         f"{len(offender['guilds'])} guild(s)"
+            }
+            for offender in offenders
+        ]
+        await ctx.send(embed=embed_msg(
+            title="Event loop stalls",
+            description=f"Stalls longer than {watchdog.threshold * 1000:.0f} ms, "
+                        f"out of the last {watchdog.stalls.maxlen}.",
+            field_values=fields
+        ))
+
+
+def setup(bot):
+    bot.add_cog(Debug(bot))
@@ -1,8 +1,11 @@
 import asyncio
 import functools
 import itertools
+import logging
 import math
+import os
 import platform
+import time
 
 import random
 import re
@@ -11,18 +14,26 @@ import discord
 import youtube_dl
 from async_timeout import timeout
 from discord.ext import commands
-from exceptions import VoiceError, YTDLError
+from exceptions import YTDLError
+from misc.buffer import BufferedStream
 from misc.embed import embed_msg, video_embed
 from misc.genius import GeniusSong
+from misc.metrics import registry
+from misc.mixer import Mixer
+from misc.playback import PlaybackStats, format_stats, watch_ffmpeg_log
+from misc.track_index import TrackIndex
+from misc.watchdog import watchdog
 
 """
 VOICE MODULE
 
 The commands include:
+  forceplay Plays a song, always searching it remotely.
   join    Joins a voice channel.
   leave   Clears the queue and leaves the voice channel.
   loop    Loops the currently playing song.
   lyrics  Get the lyrics of the current song.
+  mix     Plays a short sound over the current song.
   now     Displays the currently playing song.
   pause   Pauses the currently playing song.
   play    Plays a song.
@@ -31,11 +42,28 @@ The commands include:
   resume  Resumes a currently paused song.
   shuffle Shuffles the queue.
   skip    Vote to skip a song. The requester can automatically skip.
+  stats   Shows the audio stats of the current song.
   stop    Stops playing song and clears the queue.
   summon  Summons the bot to a voice channel.
   volume  Sets the volume of the player.
 """
 
+log = logging.getLogger(__name__)
+
+# Metrics
+COMMAND_SECONDS = registry.histogram(
+    "bot_command_seconds", "Duration of the music commands", ("command",))
+EXTRACTION_SECONDS = registry.histogram(
+    "ytdl_extraction_seconds", "Duration of YTDLSource.create_source", ("search",))
+EXTRACTION_ERRORS = registry.counter(
+    "ytdl_extraction_errors", "Failed YTDLSource.create_source calls", ("error",))
+FFMPEG_FIRST_FRAME_SECONDS = registry.histogram(
+    "ffmpeg_first_frame_seconds", "Time from the ffmpeg spawn (or the playback start, if later) to the first frame",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0))
+
+# The local track index, next to the other config files wherever the bot is started from
+TRACKS_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config", "tracks.db")
+
 
 class YTDLSource(discord.PCMVolumeTransformer):
     """
@@ -59,19 +87,32 @@ class YTDLSource(discord.PCMVolumeTransformer):
     }
 
     FFMPEG_OPTIONS = {
-        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+        'before_options': '-hide_banner -nostats -loglevel warning '
+                          '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
         'options': '-vn',
     }
 
     ytdl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
 
+    # Index of the tracks resolved before, opened by the Music cog. A query matching one of them
+    # with at least LOCAL_MATCH_THRESHOLD confidence (0 to 1) skips the remote search.
+    track_index: TrackIndex = None
+    LOCAL_MATCH_THRESHOLD = 0.75
+
     def __init__(self,
                  ctx: commands.Context,
-                 source: discord.FFmpegPCMAudio,
+                 source: discord.AudioSource,
                  *,
                  data: dict,
-                 volume: float = 0.5):
+                 volume: float = 1.0,
+                 stats: PlaybackStats = None):
         super().__init__(source, volume)  # Plays the source
+        # Frame pacing stats of the track
+        self.stats = stats or PlaybackStats()
+
+        # ffmpeg is spawned right before this. Reset started_at when the playback starts.
+        self.started_at = time.perf_counter()
+        self._first_frame = False
 
         # Get context info
         self.requester = ctx.author
@@ -86,6 +127,7 @@ class YTDLSource(discord.PCMVolumeTransformer):
         self.thumbnail = data.get('thumbnail')
         self.description = data.get('description')
         self.duration = self.parse_duration(int(data.get('duration')))
+        self.duration_seconds = data.get('duration')
         self.url = data.get('webpage_url')
 
         # Not shown in the response message. Can comment out.
@@ -96,41 +138,90 @@ class YTDLSource(discord.PCMVolumeTransformer):
     def __str__(self):
         return f'**{self.title}** by **{self.uploader}**'
 
+    def read(self) -> bytes:
+        # The volume of the player is applied by the Mixer, skip the scaling at 100%
+        data = self.original.read() if self.volume == 1.0 else super().read()
+        # The reads of ffmpeg are recorded by the BufferedStream, the player only takes the frames
+        if data:
+            self.stats.record_frame(time.perf_counter())
+
+        if not self._first_frame:
+            self._first_frame = True
+            FFMPEG_FIRST_FRAME_SECONDS.observe(time.perf_counter() - self.started_at)
+        return data
+
     @classmethod
-    async def create_source(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None):
+    async def create_source(cls,
+                            ctx: commands.Context,
+                            search: str,
+                            *,
+                            loop: asyncio.BaseEventLoop = None,
+                            remote: bool = False):
         """
         Creates a source to play.
         :param ctx: the commands.Context
         :param search: the search query
         :param loop: ...
+        :param remote: skip the local track index and always search remotely
         :return: source
         """
         loop = loop or asyncio.get_event_loop()
+        start = time.perf_counter()
+        search_type = "remote"
 
-        # Create partial function
-        partial = functools.partial(cls.ytdl.extract_info, search, download=False, process=False)
-        data = await loop.run_in_executor(None, partial)  # Execute loop
+        try:
+            if remote or cls.is_url(search):
+                # A url is extracted as it is, there is nothing to match
+                local_match = None
+            else:
+                local_match = await loop.run_in_executor(None, cls.track_index.search, search)
 
-        # Raise error if there is no data
-        if data is None:
-            raise YTDLError(f"Couldn't find anything that matches `{search}`")
+            if local_match and local_match[0] >= cls.LOCAL_MATCH_THRESHOLD:
+                # Already resolved before, go straight to the webpage url
+                search_type = "local"
+                webpage_url = local_match[1]
 
-        if 'entries' in data:
-            process_info = None
-            for entry in data['entries']:
-                if entry:
-                    process_info = entry
-                    break
+            else:
+                webpage_url = await cls.search_webpage_url(search, loop=loop)
 
-            # Raise error if there is no process_info
-            if process_info is None:
-                raise YTDLError(f"Couldn't find anything that matches `{search}`")
+            source = await cls.extract_source(ctx, webpage_url, loop=loop)
 
-        else:
-            process_info = data
+        except Exception as e:
+            EXTRACTION_ERRORS.inc(labels=(type(e).__name__,))
+            raise
+
+        EXTRACTION_SECONDS.observe(time.perf_counter() - start, (search_type,))
+        return source
+
+    @classmethod
+    async def extract_source(cls, ctx: commands.Context, webpage_url: str, *, loop: asyncio.BaseEventLoop = None):
+        """
+        Extracts the stream of a webpage url and creates the source.
+        :param ctx: the commands.Context
+        :param webpage_url: the url of the video
+        :param loop: ...
+        :return: source
+        """
+        loop = loop or asyncio.get_event_loop()
+        info = await cls.extract_info(webpage_url, loop=loop)
+
+        await loop.run_in_executor(None, cls.track_index.add, info)
+
+        stats = PlaybackStats()
+        source = cls.spawn_ffmpeg(info['url'], stats)
+        stream = cls.buffer_stream(source, info['webpage_url'], info.get('duration'), stats)
+        return cls(ctx, stream, data=info, stats=stats)
+
+    @classmethod
+    async def extract_info(cls, webpage_url: str, *, loop: asyncio.BaseEventLoop = None) -> dict:
+        """
+        Extracts the info of a webpage url, including its stream url.
+        :param webpage_url: the url of the video
+        :param loop: ...
+        :return: dict
+        """
+        loop = loop or asyncio.get_event_loop()
 
-        # Get webpage url from the data
-        webpage_url = process_info['webpage_url']
         # Create partial function to extract data from the youtube URL
         partial_data_extractor = functools.partial(cls.ytdl.extract_info, webpage_url, download=False)
         # Execute partial
@@ -150,7 +241,146 @@ class YTDLSource(discord.PCMVolumeTransformer):
         else:
             info = processed_info
 
-        return cls(ctx, discord.FFmpegPCMAudio(info['url'], **cls.FFMPEG_OPTIONS), data=info)
+        return info
+
+    @classmethod
+    async def create_overlay(cls,
+                             search: str,
+                             *,
+                             max_duration: float,
+                             loop: asyncio.BaseEventLoop = None) -> discord.AudioSource:
+        """
+        Creates a plain ffmpeg source to mix over the current song (see Mixer.add).
+        The Mixer reads it ahead itself, and its frames aren't part of the stats of the song.
+        :param search: the search query
+        :param max_duration: the longest sound allowed, in seconds
+        :param loop: ...
+        :return: discord.FFmpegPCMAudio
+        """
+        loop = loop or asyncio.get_event_loop()
+        webpage_url = search if cls.is_url(search) else await cls.search_webpage_url(search, loop=loop)
+        info = await cls.extract_info(webpage_url, loop=loop)
+
+        # Live streams have no duration
+        duration = info.get('duration')
+        if not duration or duration > max_duration:
+            raise YTDLError(f"`{info.get('title')}` is too long to be mixed, "
+                            f"sounds can be up to {max_duration:.0f} seconds long")
+
+        return cls.spawn_ffmpeg(info['url'], PlaybackStats())
+
+    @classmethod
+    def buffer_stream(cls,
+                      source: discord.AudioSource,
+                      webpage_url: str,
+                      duration: float,
+                      stats: PlaybackStats) -> BufferedStream:
+        """
+        Read ahead of the player. If the stream dies, the track is resolved again and continues where it was.
+        :param source: the ffmpeg stream
+        :param webpage_url: the url of the video
+        :param duration: the duration of the track in seconds
+        :param stats: the stats of the track
+        :return: BufferedStream
+        """
+        return BufferedStream(source,
+                              reopen=functools.partial(cls.reopen_stream, webpage_url, stats),
+                              duration=duration,
+                              stats=stats)
+
+    async def rewind(self, *, loop: asyncio.BaseEventLoop = None):
+        """
+        Replace the stream, consumed (and cleaned up) by the last playback, with a new one from the start.
+        :param loop: ...
+        """
+        loop = loop or asyncio.get_event_loop()
+
+        stats = PlaybackStats()
+        source = await loop.run_in_executor(None, self.reopen_stream, self.url, stats, 0.0)
+        self.original = self.buffer_stream(source, self.url, self.duration_seconds, stats)
+        self.stats = stats
+        self._first_frame = False
+
+    @classmethod
+    def reopen_stream(cls, webpage_url: str, stats: PlaybackStats, position: float) -> discord.FFmpegPCMAudio:
+        """
+        Resolve the track again (its stream url might have expired) and stream it from a position.
+        This blocks, it's called from the buffer thread.
+        :param webpage_url: the url of the video
+        :param stats: the stats of the track
+        :param position: where to start, in seconds
+        :return: discord.FFmpegPCMAudio
+        """
+        info = cls.ytdl.extract_info(webpage_url, download=False)
+        if info is None:
+            raise YTDLError(f"Couldn't fetch `{webpage_url}`")
+
+        if "entries" in info:
+            info = next((entry for entry in info['entries'] if entry), None)
+            if info is None:
+                raise YTDLError(f"Couldn\'t retrieve any matches for `{webpage_url}`")
+
+        return cls.spawn_ffmpeg(info['url'], stats, position)
+
+    @classmethod
+    def spawn_ffmpeg(cls, url: str, stats: PlaybackStats, position: float = 0.0) -> discord.FFmpegPCMAudio:
+        """
+        Start ffmpeg streaming the url. Its log is watched to count the reconnections.
+        :param url: the stream url
+        :param stats: the stats of the track
+        :param position: where to start, in seconds
+        :return: discord.FFmpegPCMAudio
+        """
+        options = dict(cls.FFMPEG_OPTIONS)
+        if position:
+            options['before_options'] += f' -ss {position:.2f}'
+
+        read_fd, write_fd = os.pipe()
+        try:
+            return discord.FFmpegPCMAudio(url, stderr=write_fd, **options)
+        finally:
+            # ffmpeg has its own copy, the watcher stops when ffmpeg exits
+            os.close(write_fd)
+            watch_ffmpeg_log(read_fd, stats)
+
+    @classmethod
+    async def search_webpage_url(cls, search: str, *, loop: asyncio.BaseEventLoop = None) -> str:
+        """
+        Search remotely and return the webpage url of the first match.
+        :param search: the search query
+        :param loop: ...
+        :return: str
+        """
+        loop = loop or asyncio.get_event_loop()
+
+        # Create partial function
+        partial = functools.partial(cls.ytdl.extract_info, search, download=False, process=False)
+        data = await loop.run_in_executor(None, partial)  # Execute loop
+
+        # Raise error if there is no data
+        if data is None:
+            raise YTDLError(f"Couldn't find anything that matches `{search}`")
+
+        if 'entries' in data:
+            process_info = None
+            for entry in data['entries']:
+                if entry:
+                    process_info = entry
+                    break
+
+            # Raise error if there is no process_info
+            if process_info is None:
+                raise YTDLError(f"Couldn't find anything that matches `{search}`")
+
+        else:
+            process_info = data
+
+        # Get webpage url from the data
+        return process_info['webpage_url']
+
+    @staticmethod
+    def is_url(search: str) -> bool:
+        return re.match(r"^[a-z][a-z0-9+.-]*://\S+$", search.strip(), re.IGNORECASE) is not None
 
     @staticmethod
     def parse_duration(duration: int) -> str:
@@ -228,8 +458,11 @@ class VoiceState:
         self._loop = False
         self._volume = 0.5
         self.skip_votes = set()
+        # Mixes the current song with the overlays and applies the volume. Reused by every song.
+        self.mixer = Mixer(volume=self._volume)
 
         self.audio_player = bot.loop.create_task(self.audio_player_task())
+        watchdog.tag("audio_player", ctx.guild.id, task=self.audio_player)
 
     def __del__(self):
         self.audio_player.cancel()
@@ -249,16 +482,37 @@ class VoiceState:
     @volume.setter
     def volume(self, value: float):
         self._volume = value
+        self.mixer.volume = value
 
     @property
     def is_playing(self):
         return self.voice and self.current
 
+    @property
+    def is_connected(self) -> bool:
+        return self.voice is not None and self.voice.is_connected()
+
+    @property
+    def buffer(self):
+        """The read-ahead buffer of the current song, if any"""
+        if self.current and isinstance(self.current.source.original, BufferedStream):
+            return self.current.source.original
+        return None
+
     async def audio_player_task(self):
         while True:
             self.next.clear()
 
-            if not self.loop:
+            if self.loop and self.current:
+                # The last playback cleaned up the stream of the song, play it again from a new one
+                try:
+                    await self.current.source.rewind(loop=self.bot.loop)
+                except Exception as e:
+                    log.error(f"Couldn't loop the song in guild {self._ctx.guild.id}: {e}")
+                    await self.current.source.channel.send("Couldn't play the song again, looping is disabled.")
+                    self.loop = False
+
+            if not self.loop or not self.current:
                 # Try to get the next song within 3 minutes.
                 # If no song will be added to the queue in time,
                 # the player will disconnect due to performance
@@ -270,8 +524,6 @@ class VoiceState:
                     self.bot.loop.create_task(self.stop())
                     return
 
-            self.current.source.volume = self._volume
-
             """
             Temporal fix for Darwin devices:
             self.voice.play checks whether there is an encoder defined (in my device it's not)
@@ -286,7 +538,9 @@ class VoiceState:
                 import fixes.opus_darwin  # Import opus custom class
                 self.voice.encoder = fixes.opus_darwin.Encoder()
 
-            self.voice.play(self.current.source, after=self.play_next_song)
+            self.current.source.started_at = time.perf_counter()
+            self.mixer.source = self.current.source
+            self.voice.play(self.mixer, after=self.play_next_song)
 
             # Create custom embed message
             await self.current.source.channel.send(embed=video_embed(self.current))
@@ -294,10 +548,11 @@ class VoiceState:
             await self.next.wait()
 
     def play_next_song(self, error=None):
+        # Called from the player thread. Raising here would leave the player waiting forever.
         if error:
-            raise VoiceError(str(error))
+            log.error(f"Player error in guild {self._ctx.guild.id}: {error}")
 
-        self.next.set()
+        self.bot.loop.call_soon_threadsafe(self.next.set)
 
     def skip(self):
         self.skip_votes.clear()
@@ -317,11 +572,26 @@ class Music(commands.Cog):
     """
     Main class with the commands.
     """
+    # Longest sound the mix command plays over the songs, in seconds
+    MAX_MIX_SECONDS = 30
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.voice_states = {}
 
+        if YTDLSource.track_index is None:
+            YTDLSource.track_index = TrackIndex(TRACKS_DB)
+
+        # Computed when the metrics are scraped
+        registry.gauge("bot_queue_length", "Songs waiting in the queues", ("shard",),
+                       function=lambda: self.count_by_shard(lambda state: len(state.songs)))
+        registry.gauge("bot_voice_states", "Voice states connected to a voice channel", ("shard",),
+                       function=lambda: self.count_by_shard(lambda state: int(state.is_connected)))
+        registry.gauge("audio_buffer_frames", "Frames in the read-ahead buffers of the playing songs", ("shard",),
+                       function=lambda: self.count_by_shard(lambda state: state.buffer.depth if state.buffer else 0))
+        registry.gauge("audio_buffer_target_frames", "Target depth of the read-ahead buffers", ("shard",),
+                       function=lambda: self.count_by_shard(lambda state: state.buffer.target if state.buffer else 0))
+
     def get_voice_state(self, ctx: commands.Context):
         state = self.voice_states.get(ctx.guild.id)
         if not state:
@@ -330,6 +600,14 @@ class Music(commands.Cog):
 
         return state
 
+    def count_by_shard(self, value) -> dict:
+        """Sum a value of every voice state by the shard of its guild"""
+        counts = {}
+        for state in list(self.voice_states.values()):
+            shard = (str(state._ctx.guild.shard_id),)
+            counts[shard] = counts.get(shard, 0) + value(state)
+        return counts
+
     def cog_unload(self):
         for state in self.voice_states.values():
             self.bot.loop.create_task(state.stop())
@@ -341,8 +619,13 @@ class Music(commands.Cog):
         return True
 
     async def cog_before_invoke(self, ctx: commands.Context):
+        ctx.invoked_at = time.perf_counter()
+        watchdog.tag(ctx.command.qualified_name, ctx.guild.id)
         ctx.voice_state = self.get_voice_state(ctx)
 
+    async def cog_after_invoke(self, ctx: commands.Context):
+        COMMAND_SECONDS.observe(time.perf_counter() - ctx.invoked_at, (ctx.command.qualified_name,))
+
     async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
         await ctx.send(str(error))
 
@@ -389,11 +672,11 @@ class Music(commands.Cog):
         # if not ctx.voice_state.is_playing:
         #     return await ctx.send('Nothing being played at the moment.')
 
-        if 0 > volume > 100:
+        if not 0 <= volume <= 100:
             return await ctx.send('Volume must be between 0 and 100.')
 
         ctx.voice_state.volume = volume / 100
-        await ctx.send(f"Volume of the player set to {volume}%\nThe volume will be applied in the next song.")
+        await ctx.send(f"Volume of the player set to {volume}%")
 
     @commands.command(name='now', aliases=['current', 'playing'])
     async def _now(self, ctx: commands.Context):
@@ -467,6 +750,23 @@ class Music(commands.Cog):
         else:
             await ctx.send('You have already voted to skip this song.')
 
+    @commands.command(name='stats')
+    async def _stats(self, ctx: commands.Context):
+        """Shows the audio stats of the current song.
+        ffmpeg read times, underruns (network), late frames (CPU starvation) and ffmpeg reconnections.
+        """
+        if not ctx.voice_state.is_playing:
+            raise commands.CommandError('Nothing being played at the moment.')
+
+        source = ctx.voice_state.current.source
+        embed = embed_msg(
+            title="Playback stats",
+            description=f"```css\n{source.title}\n```",
+            field_values=format_stats(source.stats, ctx.voice_state.buffer),
+            inline=True
+        )
+        await ctx.send(embed=embed)
+
     @commands.command(name='queue')
     async def _queue(self, ctx: commands.Context, *, page: int = 1):
         """Shows the player's queue.
@@ -535,12 +835,24 @@ class Music(commands.Cog):
         A list of these sites can be found here: https://rg3.github.io/youtube-dl/supportedsites.html.
         """
 
+        await self.enqueue(ctx, search)
+
+    @commands.command(name='forceplay', aliases=['fplay'])
+    async def _forceplay(self, ctx: commands.Context, *, search: str):
+        """Plays a song, always searching it remotely.
+        Use it when `play` finds an already played track that isn't the one you wanted.
+        """
+
+        await self.enqueue(ctx, search, remote=True)
+
+    async def enqueue(self, ctx: commands.Context, search: str, remote: bool = False):
+        """Joins the author's channel if needed, creates the source and puts it in the queue."""
         if not ctx.voice_state.voice:
             await ctx.invoke(self._join)
 
         async with ctx.typing():
             try:
-                source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop)
+                source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop, remote=remote)
             except YTDLError as e:
                 await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
             else:
@@ -549,6 +861,29 @@ class Music(commands.Cog):
                 await ctx.voice_state.songs.put(song)
                 await ctx.send('Enqueued {}'.format(str(source)))
 
+    @commands.command(name='mix', aliases=['overlay'])
+    async def _mix(self, ctx: commands.Context, *, search: str):
+        """Plays a short sound over the current song.
+        Useful for sound effects and announcements. The song keeps playing underneath.
+        Sounds can be up to 30 seconds long.
+        """
+        if not ctx.voice_state.is_playing:
+            raise commands.CommandError('Nothing being played at the moment.')
+
+        async with ctx.typing():
+            try:
+                source = await YTDLSource.create_overlay(search, max_duration=self.MAX_MIX_SECONDS, loop=self.bot.loop)
+            except YTDLError as e:
+                return await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
+
+        try:
+            ctx.voice_state.mixer.add(source)
+        except discord.ClientException as e:
+            source.cleanup()
+            return await ctx.send(str(e))
+
+        await ctx.message.add_reaction('✅')
+
     @commands.command(name='lyrics')
     async def _lyrics(self, ctx: commands.Context):
         """Get the lyrics of the current song."""
@@ -569,7 +904,13 @@ class Music(commands.Cog):
         lyrics = genius_song.fastlyrics()
 
         # In case of no lyrics found. Use the other (slower) method
-        if not lyrics:
+        known_artist = None if lyrics else genius_song.known_artist()
+        if known_artist:
+            # The artist was matched before, no need to search Genius again
+            artist_name = known_artist
+            lyrics = genius_song.fastlyrics(artist=artist_name)
+
+        elif not lyrics:
             res = genius_song.get_response()  # Generate a response using the Genius API to get the songs
             if res:
                 # Find the most similar artist comparing the artist on YouTube and Genius
@@ -579,7 +920,7 @@ class Music(commands.Cog):
                     await ctx.send("Couldn't find similar artists. The lyrics might not be the expected.")
 
                 # Get the lyrics using the lyricsgenius library with the new artist
-                lyrics = genius_song.fastlyrics(artist_name)
+                lyrics = genius_song.fastlyrics(artist=artist_name)
 
             else:
                 return await ctx.send(
@@ -602,7 +943,9 @@ class Music(commands.Cog):
         return await ctx.send("Lyrics couldn't be found.")
 
     @_join.before_invoke
+    @_mix.before_invoke
     @_play.before_invoke
+    @_forceplay.before_invoke
     @_volume.before_invoke
     async def ensure_voice_state(self, ctx: commands.Context):
         if not ctx.author.voice or not ctx.author.voice.channel: